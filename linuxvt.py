@@ -3,9 +3,14 @@
 # Copyright © 2012-2024 Jakub Wilk <jwilk@jwilk.net>
 # SPDX-License-Identifier: MIT
 
+import codecs
 import ctypes
 import errno
 import fcntl
+import html
+import io
+import itertools
+import operator
 import os
 import re
 
@@ -45,30 +50,9 @@ class UnimapDesc(ctypes.Structure):
         ('entries', ctypes.POINTER(Unipair))
     ]
 
-class VCSAHeader(ctypes.Structure):
-    _fields_ = [
-        ('height', ctypes.c_ubyte),
-        ('width', ctypes.c_ubyte),
-        ('x', ctypes.c_ubyte),
-        ('y', ctypes.c_ubyte),
-    ]
-
-class VCSAChar(ctypes.Structure):
-    _fields_ = [
-        ('char', ctypes.c_ubyte),
-        ('attr', ctypes.c_ubyte),
-    ]
-
-_linux_color_to_ansi = {
-    0: 0,
-    4: 1,
-    2: 2,
-    6: 3,
-    1: 4,
-    5: 5,
-    3: 6,
-    7: 7,
-}
+# Linux color numbers are ANSI color numbers with bits reversed.
+# The N-th nibble of this number is the ANSI counterpart of Linux color N:
+_linux_color_to_ansi = 0x73516240
 
 _ansi_to_css = {
     1: 'font-weight: bold',
@@ -91,22 +75,69 @@ _ansi_to_css = {
     47: 'background-color: lightgrey',
 }
 
+# Unicode maps, keyed by the TTY device number.
+# Loading a new font (e.g. with setfont) doesn't invalidate them;
+# call flush_unicode_map_cache() after that.
+_unicode_map_cache = {}
+
+def flush_unicode_map_cache():
+    _unicode_map_cache.clear()
+
+def _split_runs(text, attrs):
+    # Split the line into runs of cells with the same attributes.
+    if not attrs:
+        return
+    n = len(attrs)
+    changes = itertools.compress(range(1, n), map(operator.ne, attrs, attrs[1:]))
+    bounds = [0, *changes, n]
+    for i, j in zip(bounds, bounds[1:]):
+        yield text[i:j], attrs[i]
+
+def _is_ascii_transparent(encoding):
+    # Can ASCII bytes be written between independently encoded chunks?
+    # Not so for encodings with BOM (UTF-16) or shift states (ISO-2022-JP).
+    ascii = '\x1B[0m\n'
+    if ascii.encode(encoding) != ascii.encode('ASCII'):
+        return False
+    encoder = codecs.getincrementalencoder(encoding)('replace')
+    encoder.encode('\xE9\u3042')
+    return encoder.encode('', final=True) == b''
+
 def format_ansi(attrs):
     attrs = str.join(';', map(str, attrs))
     return f'\x1B[{attrs}m'
 
+# Characters that are not allowed in XML 1.0:
+_xml_invalid_chars = re.compile(r'[\x00-\x08\x0B\x0C\x0E-\x1F\uD800-\uDFFF\uFFFE\uFFFF]')
+
+def format_css(attrs):
+    assert 0 in attrs
+    bold = 1 in attrs
+    css = []
+    for a in attrs:
+        if a == 0:
+            continue
+        css_chunk = _ansi_to_css[a]
+        if isinstance(css_chunk, tuple):
+            css_chunk = css_chunk[bold]
+        css += [css_chunk]
+    return str.join('; ', css)
+
 class VT:
 
     def get_active_vt(self):
         try:
-            with open('/sys/class/tty/tty0/active', 'rt', encoding='ASCII') as fp:
-                tty0 = fp.read()
+            fd = os.open('/sys/class/tty/tty0/active', os.O_RDONLY)
+            try:
+                tty0 = os.read(fd, 16)
+            finally:
+                os.close(fd)
         except OSError:
             pass
         else:
-            match = re.match(r'^tty(\d+)$', tty0)
-            if match is not None:
-                return int(match.group(1))
+            tty0 = tty0.rstrip(b'\n')
+            if tty0.startswith(b'tty') and tty0[3:].isdigit():
+                return int(tty0[3:])
         console = os.open('/dev/tty0', os.O_RDONLY | os.O_NOCTTY)
         state = VTState()
         try:
@@ -150,8 +181,32 @@ class VT:
             self._vcsa = os.open(vcsa, os.O_RDONLY)
         assert self._tty is not None
         assert self._vcsa is not None
-        self._unicode_map = self._get_unicode_map()
+        tty_rdev = os.fstat(self._tty).st_rdev
+        try:
+            self._unicode_map = _unicode_map_cache[tty_rdev]
+        except LookupError:
+            self._unicode_map = _unicode_map_cache[tty_rdev] = self._get_unicode_map()
         self._hi_font_mask = self._get_hi_font_mask()
+        # Tables for decoding either half of the font with the charmap codec.
+        # The codec treats U+FFFE as undefined, so such tables can't be used.
+        self._font_tables = tuple(
+            None if '\uFFFE' in table else table
+            for table in (
+                str.join('', self._unicode_map[:0x100]),
+                str.join('', self._unicode_map[0x100:]),
+            )
+        )
+        self._hi_font_table = bytes(
+            bool(attr & self._hi_font_mask)
+            for attr in range(256)
+        )
+        self._attr_table = bytes(
+            attr & ~self._hi_font_mask
+            for attr in range(256)
+        )
+        self._ansi_attr_lut = tuple(map(self._get_ansi_attr, range(256)))
+        self._ansi_esc_lut = tuple(map(format_ansi, self._ansi_attr_lut))
+        self._ansi_esc_bytes = tuple(esc.encode('ASCII') for esc in self._ansi_esc_lut)
 
     def _get_hi_font_mask(self):
         mask = ctypes.c_ushort()
@@ -162,7 +217,7 @@ class VT:
         return mask.value >> 8
 
     def _get_unicode_map(self):
-        entries = []
+        entries = (Unipair * 0)()
         unimap_desc = UnimapDesc(count=0, entries=None)
         while True:
             try:
@@ -176,105 +231,123 @@ class VT:
                     continue
                 else:
                     raise
-            m = {}
-            for entry in entries:
-                try:
-                    old_chr = m[entry.fontpos]
-                except LookupError:
-                    m[entry.fontpos] = chr(entry.unicode)
-                else:
-                    m[entry.fontpos] = min(old_chr, chr(entry.unicode))
+            assert ctypes.sizeof(Unipair) == 4
+            pairs = memoryview(entries).cast('B')[:4 * unimap_desc.count].cast('H')
+            m = ['?'] * 512
+            # Go from the highest to the lowest code point,
+            # so that the lowest one wins if a font position has multiple mappings:
+            for uchar, fontpos in sorted(zip(pairs[0::2], pairs[1::2]), reverse=True):
+                m[fontpos] = chr(uchar)
             return m
 
     def peek_raw_data(self):
-        os.lseek(self._vcsa, 0, os.SEEK_SET)
-        header = os.read(self._vcsa, 4)
-        header = VCSAHeader.from_buffer_copy(header)
-        width, height = header.width, header.height
-        del header
+        # Width and height are stored in single bytes,
+        # so one pread() of this size always fetches the whole screen:
+        data = memoryview(os.pread(self._vcsa, 4 + 0xFF * 0xFF * 2, 0))
+        # header: height, width, cursor x, cursor y
+        height, width = data[0], data[1]
+        line_size = width * 2
         for y in range(height):
-            yield list(self._read_raw_line(width))
-
-    def _read_raw_line(self, width):
-        hi_font_mask = self._hi_font_mask
-        unicode_map = self._unicode_map
-        line = os.read(self._vcsa, width * 2)
-        line = (VCSAChar * width).from_buffer_copy(line)
-        for char in line:
-            char, attr = char.char, char.attr
-            if attr & hi_font_mask:
-                char |= 0x100
-            char = unicode_map[char]
-            attr = attr & ~hi_font_mask
-            yield char, attr
+            offset = 4 + y * line_size
+            yield self._decode_line(data[offset:offset + line_size])
+
+    def _decode_line(self, line):
+        attrs = line[1::2].tobytes()
+        fonts = attrs.translate(self._hi_font_table)
+        font_table = None
+        if fonts and not fonts.strip(fonts[:1]):
+            font_table = self._font_tables[fonts[0]]
+        if font_table is not None:
+            # All characters are from the same half of the font:
+            chars = line[0::2].tobytes()
+            [text, _] = codecs.charmap_decode(chars, 'strict', font_table)
+        else:
+            # Replace attributes with the hi-font bit,
+            # so that every cell becomes a little-endian 16-bit font position:
+            fontpos = bytearray(line)
+            fontpos[1::2] = fonts
+            text = fontpos.decode('UTF-16-LE').translate(self._unicode_map)
+        attrs = attrs.translate(self._attr_table)
+        return text, attrs
 
     def peek_text(self):
-        lines = self.peek_raw_data()
         return str.join('', (
-            str.join('', (char for char, attr in line)) + '\n'
-            for line in lines
+            text + '\n'
+            for text, attrs in self.peek_raw_data()
         ))
 
     def _get_ansi_attr(self, attr=None):
         if attr is None:
-            return [0]
-        blink = 5 if attr & 1 else 0
-        bold = 1 if attr & 16 else 0
-        fg = 30 + _linux_color_to_ansi[(attr & 15) >> 1]
-        bg = 40 + _linux_color_to_ansi[attr >> 5]
-        result = [0, fg, bg]
-        if bold:
-            result += [bold]
-        if blink:
-            result += [blink]
-        return result
+            return (0,)
+        fg = 30 + (_linux_color_to_ansi >> 4 * ((attr & 15) >> 1) & 0xF)
+        bg = 40 + (_linux_color_to_ansi >> 4 * (attr >> 5) & 0xF)
+        bold = (1,) * (attr >> 4 & 1)
+        blink = (5,) * (attr & 1)
+        return (0, fg, bg) + bold + blink
 
     def peek_ansi(self):
-        last_ansi_attr = default_ansi_attr = self._get_ansi_attr()
-        result = []
-        for line in self.peek_raw_data():
-            for char, attr in line:
-                ansi_attr = self._get_ansi_attr(attr)
-                if ansi_attr != last_ansi_attr:
-                    result += [format_ansi(ansi_attr)]
-                    last_ansi_attr = ansi_attr
-                result += [char]
-            result += [format_ansi(default_ansi_attr), '\n']
-            last_ansi_attr = default_ansi_attr
-        return str.join('', result)
+        reset = format_ansi(self._get_ansi_attr())
+        lines = list(self.peek_raw_data())
+        all_attrs = bytes.join(b'', (attrs for text, attrs in lines))
+        if all_attrs and min(all_attrs) == max(all_attrs):
+            # The whole screen uses the same attributes:
+            esc = self._ansi_esc_lut[all_attrs[0]]
+            return str.join('', (
+                esc + text + reset + '\n'
+                for text, attrs in lines
+            ))
+        result = io.StringIO()
+        for text, attrs in lines:
+            for run, attr in _split_runs(text, attrs):
+                result.write(self._ansi_esc_lut[attr])
+                result.write(run)
+            result.write(reset + '\n')
+        return result.getvalue()
+
+    def write_ansi(self, fp):
+        reset = format_ansi(self._get_ansi_attr()) + '\n'
+        reset_bytes = reset.encode('ASCII')
+        try:
+            buffer = fp.buffer
+            encoding = fp.encoding
+            errors = fp.errors or 'strict'
+        except AttributeError:
+            encoding = None
+        if encoding is None or not _is_ascii_transparent(encoding):
+            fp.write(self.peek_ansi())
+            return
+        fp.flush()
+        for text, attrs in self.peek_raw_data():
+            if attrs and not attrs.strip(attrs[:1]):
+                # The whole line uses the same attributes:
+                esc = self._ansi_esc_bytes[attrs[0]]
+                buffer.write(esc + text.encode(encoding, errors) + reset_bytes)
+            else:
+                line = str.join('', [
+                    self._ansi_esc_lut[attr] + run
+                    for run, attr in _split_runs(text, attrs)
+                ])
+                buffer.write((line + reset).encode(encoding, errors))
+        buffer.flush()
 
     def peek_xhtml(self):
+        result = ['<pre class="tty">']
+        for text, attrs in self.peek_raw_data():
+            # Replace characters that can't be represented in XML
+            # with U+FFFD REPLACEMENT CHARACTER:
+            text = _xml_invalid_chars.sub('\uFFFD', text)
+            for run, attr in _split_runs(text, attrs):
+                css = format_css(self._ansi_attr_lut[attr])
+                run = html.escape(run, quote=False)
+                result += [f'<span style="{css}">{run}</span>']
+            if text:
+                result += ['\n']
+        result += ['</pre>\n']
+        return str.join('', result)
+
+    def peek_xhtml_tree(self):
         import lxml.html
-        root_elt = lxml.html.Element('pre')
-        root_elt.attrib['class'] = 'tty'
-        last_ansi_attr = self._get_ansi_attr()
-        elt = None
-        for line in self.peek_raw_data():
-            if elt is not None:
-                elt.tail = '\n'
-                elt = None
-            for char, attr in line:
-                ansi_attr = self._get_ansi_attr(attr)
-                if (ansi_attr != last_ansi_attr) or (elt is None):
-                    last_ansi_attr = ansi_attr
-                    elt = lxml.html.Element('span')
-                    root_elt.append(elt)
-                    assert 0 in ansi_attr
-                    bold = 1 in ansi_attr
-                    css = []
-                    for a in ansi_attr:
-                        if a == 0:
-                            continue
-                        css_chunk = _ansi_to_css[a]
-                        if isinstance(css_chunk, tuple):
-                            css_chunk = css_chunk[bold]
-                        css += [css_chunk]
-                    css = str.join('; ', css)
-                    elt.attrib['style'] = str(css)
-                elt.text = (elt.text or '') + char
-        if elt is not None:
-            elt.tail = '\n'
-        return lxml.html.tostring(root_elt, encoding='unicode') + '\n'
+        return lxml.html.fragment_fromstring(self.peek_xhtml())
 
     def __enter__(self):
         return self
@@ -287,6 +360,9 @@ class VT:
             os.close(self._vcsa)
             self._vcsa = None
 
-__all__ = ['VT']
+__all__ = [
+    'VT',
+    'flush_unicode_map_cache',
+]
 
 # vim:ts=4 sts=4 sw=4 et